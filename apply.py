@@ -1,12 +1,16 @@
+import argparse
 import torch 
 import os 
+import sys
 import zarr
 
+from collections import Counter
+from numcodecs import Blosc
 from datetime import datetime 
 
 from src.data_loader import EMData
 from src.processing.predict import Prediction
-from src.model.model import DetectionModel
+from src.model.model import DetectionModel, compile_model
 from src.processing.post_processing.hough_detector import HoughDetector
 from src.directory_organisor import create_unique_directory_file
 from src.visualisation import imshow_napari_prediction
@@ -14,7 +18,7 @@ from src.visualisation import imshow_napari_prediction
 from config.load_configs import TRAINING_CONFIG
 from config.load_configs import POST_PROCESSING_CONFIG
 
-def Apply(zarr_path: str, model_checkpoint: str):
+def Apply(zarr_path: str, model_checkpoint: str, clahe = TRAINING_CONFIG.clahe, create_clahe = None):
     """
         Use a pretrained vesicle detection model to predict vesicles in unlablled data. 
 
@@ -25,9 +29,14 @@ def Apply(zarr_path: str, model_checkpoint: str):
             path will be fed into the EMData class. 
         model_checkpoint (str):
             Path to the model that should be used for prediction. 
+        clahe (bool):
+            Whether to predict on the clahe raw data. Default set using training_config.yaml.
+        create_clahe (bool):
+            Whether to create missing clahe raw data. If None, the user is asked when running in 
+            a terminal, and the data is created otherwise. Default: None.
     """
 
-    data = EMData(zarr_path, 'predict', clahe=TRAINING_CONFIG.clahe)
+    data = EMData(zarr_path, 'predict', clahe=clahe, create_clahe=create_clahe)
     candidates = None
     
     # Check if there are multiple channels within the raw data.
@@ -43,20 +52,44 @@ def Apply(zarr_path: str, model_checkpoint: str):
                 voxel_size = data.voxel_size
                 )
 
+    # Prediction does not need full precision weights, so halve the weight and activation 
+    # memory traffic with bfloat16. The checkpoint is cast when it is loaded into the model.
+    # mixed_precision is only set when enabled in model_config.yaml and supported by the gpu.
+    if detection_model.mixed_precision:
+        detection_model = detection_model.to(torch.bfloat16)
+
+    # Compile the model on the GPU, falling back to eager mode if compiling fails. The 
+    # tile shape is fixed, so cuda graphs can be captured once and replayed for every tile.
+    if torch.cuda.is_available() and hasattr(detection_model, 'compile'):
+        compile_model(
+                    detection_model, 
+                    input_shape = TRAINING_CONFIG.input_shape, 
+                    device = torch.device('cuda'), 
+                    mode = 'reduce-overhead'
+                    )
+
     # Initiate a prediction
     predictor = Prediction(data = data,
                             model = detection_model,
                             input_shape = TRAINING_CONFIG.input_shape, 
-                            checkpoint = model_checkpoint)
+                            checkpoint = model_checkpoint,
+                            channels_last = True)
     
     # Display the border of the output predicition compared to input shape 
     #predictor.print_border_message()
+
+    date = datetime.today().strftime('%d_%m_%Y')
+
+    # Create save location
+    save_path = create_unique_directory_file(zarr_path + f'/predict/Predictions/{date}')
+    save_location = os.path.relpath(save_path, zarr_path + '/predict')
+    f = zarr.open(zarr_path + '/predict', mode='r+')
     
-    # Get probablities
-    ret = predictor.predict_pipeline()
-    probs = torch.nn.Softmax(dim=0)(torch.tensor(ret['prediction'].data))
-    pos_pred_data = probs[1,:,:,:].detach().numpy()
-    neg_pred_data = probs[2,:,:,:].detach().numpy()
+    # Predict probablities tile by tile straight into the save location, then read 
+    # back only the PC+ and PC- channels
+    probs = predictor.predict_to_zarr(f, save_location + '/Probabilities')
+    pos_pred_data = probs[1]
+    neg_pred_data = probs[2]
 
     # Post process with hough detector
     hough_detection = HoughDetector(pred_pos = pos_pred_data,
@@ -68,49 +101,67 @@ def Apply(zarr_path: str, model_checkpoint: str):
     
     candidates = hough_detection.accepted_candidates
 
-    date = datetime.today().strftime('%d_%m_%Y')
-
-    # Create save location
-    save_path = create_unique_directory_file(data_path + f'/predict/Predictions/{date}')
-    save_location = os.path.relpath(save_path, data_path + '/predict')
-
     # Save the validation prediction in zarr dictionary. 
-    f = zarr.open(data_path + '/predict', mode='r+')
-    f[save_location + '/Hough_transformed'] = hough_pred
-
-    for atr in data.raw_data.attrs:
-        f[save_location + '/Hough_transformed'].attrs[atr] = data.raw_data.attrs[atr]
+    hough_array = f.create_dataset(
+                    save_location + '/Hough_transformed',
+                    data = hough_pred,
+                    chunks = (min(64, hough_pred.shape[0]), min(256, hough_pred.shape[1]), min(256, hough_pred.shape[2])),
+                    compressor = Blosc(cname='lz4', clevel=3, shuffle=Blosc.SHUFFLE),
+                    overwrite = True
+                    )
+
+    # The clahe 'scale' attribute describes the raw intensities, not the labels
+    hough_array.attrs.update({atr: value for atr, value in data.raw_data.attrs.asdict().items() if atr != 'scale'})
     
     return candidates, save_path
 
 if __name__ == "__main__":
-        
-    data_path = input("Provide path to zarr container: ")
-
-    print("-----")
 
-    model_checkpoint = input("Provide the path to the model checkpoint: ")
+    parser = argparse.ArgumentParser(description="Predict vesicles using a pretrained model.")
+    parser.add_argument("--zarr", required=True, help="Path to the zarr container.")
+    parser.add_argument("--model-checkpoint", required=True, help="Path to the model checkpoint.")
+    parser.add_argument("--clahe", action=argparse.BooleanOptionalAction, default=TRAINING_CONFIG.clahe,
+                        help="Whether to predict on the clahe raw data. Default set using training_config.yaml.")
+    parser.add_argument("--create-clahe", action=argparse.BooleanOptionalAction, default=None,
+                        help="Whether to create the clahe raw data if it is missing. Default: ask when run in a terminal, otherwise create.")
+    parser.add_argument("--visualise", action="store_true", help="Visualise the prediction in napari.")
+
+    # Only ask for inputs when run interactively without arguments
+    if len(sys.argv) == 1 and sys.stdin.isatty():
+        
+        data_path = input("Provide path to zarr container: ")
 
-    print("-----")
+        print("-----")
 
-    visualise = input("Would you like to visualise the prediction? (y/n): ")
+        model_checkpoint = input("Provide the path to the model checkpoint: ")
 
-    while visualise.lower() != 'y' and visualise.lower() != 'n':
         print("-----")
-        print("Invalid input. Please enter 'y' or 'n' only.")
+
         visualise = input("Would you like to visualise the prediction? (y/n): ")
 
+        while visualise.lower() != 'y' and visualise.lower() != 'n':
+            print("-----")
+            print("Invalid input. Please enter 'y' or 'n' only.")
+            visualise = input("Would you like to visualise the prediction? (y/n): ")
+
+        clahe = TRAINING_CONFIG.clahe
+        create_clahe = None
+
+    else:
+        args = parser.parse_args()
+        data_path = args.zarr
+        model_checkpoint = args.model_checkpoint
+        visualise = 'y' if args.visualise else 'n'
+        clahe = args.clahe
+        create_clahe = args.create_clahe
+
     print("-----")
 
-    candidates, save_location = Apply(zarr_path=data_path, model_checkpoint=model_checkpoint)
+    candidates, save_location = Apply(zarr_path=data_path, model_checkpoint=model_checkpoint, clahe=clahe, create_clahe=create_clahe)
 
-    pos_labels = 0 
-    neg_labels = 0
-    for candidate in candidates:
-            if candidate.label == 1:
-                pos_labels += 1 
-            if candidate.label == 2:
-                neg_labels +=1 
+    label_counts = Counter(int(candidate.label) for candidate in candidates)
+    pos_labels = label_counts.get(1, 0)
+    neg_labels = label_counts.get(2, 0)
 
     print(f"PC+ predictions: {pos_labels}", f"PC- predictions: {neg_labels}")
 
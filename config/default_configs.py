@@ -6,6 +6,7 @@ model_config["fmap_inc_factors"] = 5
 model_config["downsample_factors"] = [tuple([1,1,1]), tuple([1,1,1])]
 model_config["padding"] = 'valid'
 model_config["constant_upsample"] = True 
+model_config["mixed_precision"] = True
 
 training_config = dict()
 training_config["clahe"] = True 
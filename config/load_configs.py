@@ -2,15 +2,29 @@ import yaml
 import gunpowder as gp 
 import math
 
+# Use the libyaml C loader when available. The FullLoader is required (rather than the 
+# SafeLoader) as the config files contain python tuples.
+try:
+    from yaml import CFullLoader as YamlLoader
+except ImportError:
+    from yaml import FullLoader as YamlLoader
+
+def load_yaml(path):
+    """
+        Load a yaml file into a dictionary.
+    """
+    with open(path, "r") as file_object:
+        return yaml.load(file_object, Loader=YamlLoader)
+
 class ModelConfigs:
     def __init__(self):
-        with open("config/model_config.yaml", "r") as file_object:
-            config = yaml.full_load(file_object)
+        config = load_yaml("config/model_config.yaml")
 
         self.constant_upsample = config["constant_upsample"]
         self.downsample_factors = config["downsample_factors"]
         self.fmap_inc_factors = config["fmap_inc_factors"]
         self.fmaps = config["fmaps"]
+        self.mixed_precision = config["mixed_precision"]
         self.padding = config["padding"]
         
         for key, value in zip(config.keys(), config.values()):
@@ -19,8 +33,7 @@ class ModelConfigs:
 
 class TrainingConfigs:
     def __init__(self):
-        with open("config/training_config.yaml", "r") as file_object:
-            config = yaml.full_load(file_object)
+        config = load_yaml("config/training_config.yaml")
 
         self.augmentations = [eval(aug) for aug in config['augmentations']]
         self.batch_size = config["batch_size"]
@@ -40,8 +53,7 @@ class TrainingConfigs:
 
 class PostProcessingConfigs:
     def __init__(self):
-        with open("config/post_processing_config.yaml", "r") as file_object:
-            config = yaml.full_load(file_object)
+        config = load_yaml("config/post_processing_config.yaml")
 
         self.combine_pos_neg = config["combine_pos_neg"]
         self.maxima_threshold = config["maxima_threshold"]
@@ -53,8 +65,7 @@ class PostProcessingConfigs:
 
 class TiffToZarrTrainConfigs:
     def __init__(self):
-        with open("config/tiff_to_zarr_train_config.yaml", "r") as file_object:
-            config = yaml.full_load(file_object)
+        config = load_yaml("config/tiff_to_zarr_train_config.yaml")
 
         self.attributes = config["attributes"]
         self.output_zarr_path = config["output_zarr_path"]
@@ -71,8 +82,7 @@ class TiffToZarrTrainConfigs:
 
 class TiffToZarrPredictConfigs:
     def __init__(self):
-        with open("config/tiff_to_zarr_predict_config.yaml", "r") as file_object:
-            config = yaml.full_load(file_object)
+        config = load_yaml("config/tiff_to_zarr_predict_config.yaml")
 
         self.attributes = config["attributes"]
         self.output_zarr_path = config["output_zarr_path"]
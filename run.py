@@ -1,27 +1,80 @@
+import argparse
 import os
 import gunpowder as gp
 import numpy as np
+import pandas as pd
 import yaml
 import torch 
 import shutil
-import csv
+import sys
 
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from datetime import datetime
 
 from src.processing.training import Training, TrainingStatistics
+from src.model.model import compile_model
 from src.visualisation import imshow_napari_validation
 from src.directory_organisor import create_unique_directory_file
-from config.load_configs import TRAINING_CONFIG
+from config.load_configs import TRAINING_CONFIG, load_yaml
 from src.processing.validate import Validations, validate
 from src.save_validations import save_validations
 
+def _state_to_cpu(state):
+    """
+        Recursively copy the tensors within a (nested) state dictionary to the cpu, so the 
+        copy is unaffected by further training updates. 
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: _state_to_cpu(v) for k,v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_state_to_cpu(v) for v in state)
+    return state
+
+# The scores computed for each validation run
+SCORE_NAMES = tuple(sys.intern(score_name) for score_name in (
+                                                        'precision_1', 
+                                                        'recall_1', 
+                                                        'fscore_1',
+                                                        'precision_2', 
+                                                        'recall_2', 
+                                                        'fscore_2',
+                                                        'precision_average', 
+                                                        'recall_average', 
+                                                        'fscore_average'
+                                                        ))
+
+def _link_or_copy(src, dst):
+    """
+        Hard link src to dst, falling back to a copy if linking is not possible 
+        (e.g. different file systems). 
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+def _save_checkpoint(state, path):
+    """
+        Save a checkpoint to a temporary file and move it into place. This creates a new 
+        file rather than overwriting the existing one, so checkpoints hard linked from a 
+        previous run are left untouched.
+    """
+    torch.save(state, path + ".tmp", _use_new_zipfile_serialization=True)
+    os.replace(path + ".tmp", path)
+
 class Run():
 
     def __init__(
             self,
             zarr_path: str,
-            best_score_name = TRAINING_CONFIG.best_score_name
+            best_score_name = TRAINING_CONFIG.best_score_name,
+            clahe = TRAINING_CONFIG.clahe,
+            has_mask = TRAINING_CONFIG.has_mask,
+            create_clahe = None
             ):
         
         """ 
@@ -41,10 +94,16 @@ class Run():
                 The score which determines the model to be visualised.
             best_score (float):
                 The best validation value for best_score_name. 
+            num_workers (int):
+                The number of worker processes used to prepare training batches.
+            cache_size (int):
+                The number of prepared training samples held in the pre-cache. 
             best_scores (dict):
                 Dictionary storying the best validation scores for each score name, along with the corresponding iteration number. 
             best_validations (dict):
                 Dictionary storying the instances of the Validations class, corresponding to the best scores. 
+            prediction_buffers (dict):
+                Buffers reused between validation runs when computing prediction probabilities. 
             model_save_path (str):
                 Path to save the model.
             checkpoint_path (str):
@@ -57,27 +116,44 @@ class Run():
             best_score_name (str):
                 Provide the name of the score that the user is interested in maximising. 
                 Default is set by the training_config.yaml file. 
+            clahe (bool):
+                Whether to train on the clahe raw data. Default is set by the training_config.yaml file. 
+            has_mask (bool):
+                Whether the training data contains a mask. Default is set by the training_config.yaml file. 
+            create_clahe (bool):
+                Whether to create missing clahe raw data. If None, the user is asked when running in a 
+                terminal, and the data is created otherwise. Default is None.
         """
 
         self.zarr_path = zarr_path
-        self.training = Training(zarr_path = self.zarr_path)
+        self.training = Training(zarr_path = self.zarr_path, clahe = clahe, training_has_mask = has_mask, create_clahe = create_clahe)
+
+        # Compile the model on the GPU, falling back to eager mode if compiling fails
+        if torch.cuda.is_available() and hasattr(self.training.detection_model, 'compile'):
+            compile_model(
+                        self.training.detection_model, 
+                        input_shape = self.training.input_shape, 
+                        device = self.training.device, 
+                        mode = 'max-autotune', 
+                        training = True
+                        )
+
         self.training_stats = TrainingStatistics()
         self.validations = []
         self.best_score_name = best_score_name
         self.best_score = 0.0
+        self.num_workers = max(1, (os.cpu_count() or 1)//2)
+        self.cache_size = 4*TRAINING_CONFIG.batch_size
 
-        self.best_scores = {
-                            'precision_1': (0,"Iteration "), 
-                            'recall_1': (0,"Iteration "), 
-                            'fscore_1': (0,"Iteration "),
-                            'precision_2': (0,"Iteration "), 
-                            'recall_2': (0,"Iteration "), 
-                            'fscore_2': (0,"Iteration "),
-                            'precision_average': (0,"Iteration "), 
-                            'recall_average': (0,"Iteration "), 
-                            'fscore_average': (0,"Iteration ")
-                            }
+        self.best_scores = {score_name: (0,"Iteration ") for score_name in SCORE_NAMES}
         self.best_validations = {}
+
+        # Reusable buffers for converting validation predictions into probabilities
+        self.prediction_buffers = {}
+
+        # Checkpoints are written in a background thread
+        self._save_pool = ThreadPoolExecutor(max_workers=1)
+        self._save_futures = []
         
     def run_training(self, model_path=None): 
         """ 
@@ -104,23 +180,26 @@ class Run():
             checkpoint = torch.load(self.checkpoint_path, map_location=self.training.device)
             self.training.detection_model.load_state_dict(checkpoint["model_state_dict"])
             self.training.optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
-            with open(model_path + "/best_scores.yaml", "r") as file_object:
-                self.best_scores = yaml.full_load(file_object)
+            self.best_scores = load_yaml(model_path + "/best_scores.yaml")
 
             for k,v in self.best_scores.items():
                 stripped_v = v[1].replace("*", "")
-                self.best_scores[f"{k}"] = (v[0], stripped_v+"*") 
+                self.best_scores[k] = (v[0], stripped_v+"*") 
 
-                # Save previous model checkpoints and best validations into new saved model folder
-                shutil.copytree(f"{model_path}/model_checkpoints", f"{self.model_save_path}/model_checkpoints", dirs_exist_ok=True)
-                shutil.copytree(f"{model_path}/best_validations", f"{self.model_save_path}/best_validations", dirs_exist_ok=True)
+            # Save previous model checkpoints and best validations into new saved model folder.
+            # Checkpoints are hard linked where possible rather than copied. 
+            shutil.copytree(f"{model_path}/model_checkpoints", f"{self.model_save_path}/model_checkpoints", dirs_exist_ok=True, copy_function=_link_or_copy)
+            shutil.copytree(f"{model_path}/best_validations", f"{self.model_save_path}/best_validations", dirs_exist_ok=True)
 
             print("Resuming training from model with previous scores:")
             print(self.best_scores)
 
 
         # Get pipeline and request for training
-        pipeline, request = self.training.training_pipeline()
+        pipeline, request = self.training.training_pipeline(
+                                                        cache_size = self.cache_size,
+                                                        num_workers = self.num_workers
+                                                        )
 
         # run the training pipeline for interations
         print(f"Starting training for {TRAINING_CONFIG.iterations} iterations...")
@@ -128,45 +207,13 @@ class Run():
             for i in tqdm(range(TRAINING_CONFIG.iterations)):
                 batch = pipeline.request_batch(request)
                 train_time = batch.profiling_stats.get_timing_summary('Train', 'process').times[-1]
-                self.training_stats.add_stats(iteration=i, loss=batch.loss, time=train_time)
+                self.training_stats.add_stats(i, batch.loss, train_time)
 
                 # Validate model during training 
                 if (i % TRAINING_CONFIG.val_every == 0) and (i>0):
                     print("\n Running validation...")
-                    scores, predictions, candidates, val_loss = validate(
-                                                            validation_data=self.training.validate_data,
-                                                            model = self.training.detection_model,
-                                                            input_shape = self.training.input_shape
-                                                            )
-                    
-                    self.validations.append(
-                                    Validations(
-                                        iteration=i, 
-                                        scores=scores, 
-                                        predictions=predictions,
-                                        candidates=candidates,
-                                        loss=val_loss) 
-                                    )
-                    
-                    # Check for best validation scores
-                    for k,v in scores.items(): 
-                        if v > self.best_scores[f'{k}'][0]:
-                            self.best_scores[f'{k}'] = (v, f"Iteration {i}")
-                            self.best_validations[f'{k}'] = Validations(
-                                                                    iteration=i, 
-                                                                    scores=scores, 
-                                                                    predictions=predictions,
-                                                                    candidates=candidates,
-                                                                    loss=val_loss)
-                            
-                            torch.save( 
-                                {
-                                    "model_state_dict": self.training.detection_model.state_dict(),
-                                    "optimizer_state_dict": self.training.optimizer.state_dict()
-                                }, 
-                                f"{self.model_save_path}/model_checkpoints/{k}" 
-                            )
-                            
+                    self.run_validation(iteration=i)
+
                     # Display validation scores to terminal
                     print(self.best_scores)
 
@@ -175,48 +222,105 @@ class Run():
             print("Running final validation...")
 
             train_time = batch.profiling_stats.get_timing_summary('Train', 'process').times[-1]
-            self.training_stats.add_stats(iteration=TRAINING_CONFIG.iterations, loss=batch.loss, time=train_time)
+            self.training_stats.add_stats(TRAINING_CONFIG.iterations, batch.loss, train_time)
 
             # Compute the final validation after training complete
-            scores, predictions, candidates, val_loss = validate(
-                                        validation_data=self.training.validate_data,
-                                        model = self.training.detection_model,
-                                        input_shape = self.training.input_shape
-                                        )
-            
-            self.validations.append(
-                                    Validations(
-                                        iteration=TRAINING_CONFIG.iterations, 
-                                        scores=scores, 
-                                        predictions=predictions,
-                                        candidates=candidates, 
-                                        loss=val_loss) 
-                                    )
-
-            # Check for best validation scores
-            for k,v in scores.items(): 
-                if v > self.best_scores[f'{k}'][0]:
-                    self.best_scores[f'{k}'] = (v, f"Iteration {TRAINING_CONFIG.iterations}")
-                    self.best_validations[f'{k}'] = Validations(
-                                                            iteration=TRAINING_CONFIG.iterations, 
-                                                            scores=scores, 
-                                                            predictions=predictions,
-                                                            candidates=candidates,
-                                                            loss=val_loss)
-                    
-                    torch.save( 
-                                {
-                                    "model_state_dict": self.training.detection_model.state_dict(),
-                                    "optimizer_state_dict": self.training.optimizer.state_dict()
-                                }, 
-                                f"{self.model_save_path}/model_checkpoints/{k}"
-                            )
+            self.run_validation(iteration=TRAINING_CONFIG.iterations)
+
+            # Ensure all checkpoints have been written before finishing
+            self.wait_for_checkpoints()
             
             # Display validation scores to terminal
             print(self.best_scores)
 
     
-            self.best_score = self.best_scores[f'{self.best_score_name}']
+            self.best_score = self.best_scores[self.best_score_name]
+
+    def run_validation(self, iteration):
+        """
+            Run a validation of the current model, updating the best scores and saving 
+            checkpoints for any improved scores. 
+
+            Parameters
+            -------------------
+            iteration (int):
+                The training iteration the validation corresponds to. 
+
+            Returns
+            -------------------
+            validation (Validations):
+                The result of the validation run. 
+        """
+
+        # No gradients are needed for validation
+        with torch.inference_mode():
+            scores, predictions, candidates, val_loss = validate(
+                                                    validation_data=self.training.validate_data,
+                                                    model = self.training.detection_model,
+                                                    input_shape = self.training.input_shape,
+                                                    buffers = self.prediction_buffers
+                                                    )
+
+        # Prediction switches the model to eval mode, so switch back to resume training
+        self.training.detection_model.train()
+        
+        validation = Validations(
+                            iteration=iteration, 
+                            scores=scores, 
+                            predictions=predictions,
+                            candidates=candidates,
+                            loss=val_loss) 
+        self.validations.append(validation)
+        
+        # Check for best validation scores
+        improved_scores = []
+        for k,v in scores.items(): 
+            if v > self.best_scores[k][0]:
+                self.best_scores[k] = (v, f"Iteration {iteration}")
+                self.best_validations[k] = validation
+                improved_scores.append(k)
+
+        self.save_checkpoints(improved_scores)
+
+        return validation
+
+    def save_checkpoints(self, score_names):
+        """
+            Save the current model and optimizer states as the checkpoint for each of score_names. 
+            The states are copied to the cpu immediately, while writing to disk happens in a 
+            background thread so that training can continue. 
+
+            Parameters
+            -------------------
+            score_names (list):
+                The score names whose checkpoints should be replaced by the current model. 
+        """
+
+        if len(score_names) == 0:
+            return
+
+        state = _state_to_cpu({
+                                "model_state_dict": self.training.detection_model.state_dict(),
+                                "optimizer_state_dict": self.training.optimizer.state_dict()
+                            })
+
+        for k in score_names:
+            self._save_futures.append(
+                                self._save_pool.submit(
+                                                    _save_checkpoint,
+                                                    state,
+                                                    f"{self.model_save_path}/model_checkpoints/{k}"
+                                                    )
+                                )
+
+    def wait_for_checkpoints(self):
+        """
+            Block until all pending checkpoint writes have finished. Raises any error 
+            that occurred while writing. 
+        """
+        for future in self._save_futures:
+            future.result()
+        self._save_futures = []
 
     def save_run(self, load_model: str):
         """
@@ -227,11 +331,8 @@ class Run():
             the training configurations used. 
         """
         
-        # Load and save the training configurations used for the run
-        with open("config/training_config.yaml", "r") as file_object:
-            train_config = yaml.full_load(file_object)
-        with open(self.model_save_path + "/training_config_used.yaml", "w") as file_object:
-            yaml.dump(train_config, file_object)
+        # Save the training configurations used for the run
+        shutil.copyfile("config/training_config.yaml", self.model_save_path + "/training_config_used.yaml")
 
         # Save the validations
         save_validations(best_validations = self.best_validations, 
@@ -243,8 +344,10 @@ class Run():
             yaml.dump(self.best_scores, file_object)
         
         # Compute number of PC+ and PC- labels
-        pos_labels = sum(1 for row in csv.DictReader(open(f'{self.model_save_path}/best_validations/{self.best_score_name}/candidates.csv')) if int(row['label']) == 1)
-        neg_labels = sum(1 for row in csv.DictReader(open(f'{self.model_save_path}/best_validations/{self.best_score_name}/candidates.csv')) if int(row['label']) == 2)
+        labels = pd.read_csv(f'{self.model_save_path}/best_validations/{self.best_score_name}/candidates.csv', usecols=['label'])['label']
+        label_counts = np.bincount(labels.to_numpy(dtype=np.int64), minlength=3)
+        pos_labels = int(label_counts[1])
+        neg_labels = int(label_counts[2])
 
         # Create summary dictionary for summary json file
         summary_dict = {}
@@ -261,41 +364,73 @@ class Run():
 
 if __name__ == "__main__":
 
-    # Request path to zarr container from user 
-    data_path = input("Provide path to zarr container: ")
+    parser = argparse.ArgumentParser(description="Train a vesicle detection model.")
+    parser.add_argument("--zarr", required=True, help="Path to the zarr container.")
+    parser.add_argument("--clahe", action=argparse.BooleanOptionalAction, default=TRAINING_CONFIG.clahe,
+                        help="Whether to train on the clahe raw data. Default set using training_config.yaml.")
+    parser.add_argument("--create-clahe", action=argparse.BooleanOptionalAction, default=None,
+                        help="Whether to create the clahe raw data if it is missing. Default: ask when run in a terminal, otherwise create.")
+    parser.add_argument("--has-mask", action=argparse.BooleanOptionalAction, default=TRAINING_CONFIG.has_mask,
+                        help="Whether the training data contains a mask. Default set using training_config.yaml.")
+    parser.add_argument("--model-path", default=None, help="Path to a saved model to continue training.")
+    parser.add_argument("--visualise", action="store_true", help="Visualise the best prediction in napari.")
 
-    print("-----")
-    load_model = input("Would you like to continue training a previous model? (y/n): ")
+    # Only ask for inputs when run interactively without arguments
+    if len(sys.argv) == 1 and sys.stdin.isatty():
+
+        # Request path to zarr container from user 
+        data_path = input("Provide path to zarr container: ")
 
-    while load_model.lower() != 'y' and load_model.lower() != 'n':
         print("-----")
-        print("Invalid input. Please enter 'y' or 'n' only.")
         load_model = input("Would you like to continue training a previous model? (y/n): ")
 
-    if load_model.lower() == 'y':
-        model_path = input("Provide path to the saved model: ")
-
-        while not os.path.exists(model_path):
+        while load_model.lower() != 'y' and load_model.lower() != 'n':
             print("-----")
-            print("Could not find model checkpoints. Please try again.")
+            print("Invalid input. Please enter 'y' or 'n' only.")
+            load_model = input("Would you like to continue training a previous model? (y/n): ")
+
+        if load_model.lower() == 'y':
             model_path = input("Provide path to the saved model: ")
-    
-    else:
-        model_path = None
 
-    print("-----")
-    visualise = input("Would you like to visualise the prediction? (y/n): ")
+            while not os.path.exists(model_path):
+                print("-----")
+                print("Could not find model checkpoints. Please try again.")
+                model_path = input("Provide path to the saved model: ")
+        
+        else:
+            model_path = None
 
-    while visualise.lower() != 'y' and visualise.lower() != 'n':
         print("-----")
-        print("Invalid input. Please enter 'y' or 'n' only.")
         visualise = input("Would you like to visualise the prediction? (y/n): ")
 
+        while visualise.lower() != 'y' and visualise.lower() != 'n':
+            print("-----")
+            print("Invalid input. Please enter 'y' or 'n' only.")
+            visualise = input("Would you like to visualise the prediction? (y/n): ")
+
+        clahe = TRAINING_CONFIG.clahe
+        has_mask = TRAINING_CONFIG.has_mask
+        create_clahe = None
+
+    else:
+        args = parser.parse_args()
+
+        if args.model_path is not None and not os.path.exists(args.model_path):
+            parser.error(f"Could not find model checkpoints at {args.model_path}.")
+
+        data_path = args.zarr
+        model_path = args.model_path
+        load_model = 'y' if model_path is not None else 'n'
+        visualise = 'y' if args.visualise else 'n'
+        clahe = args.clahe
+        has_mask = args.has_mask
+        create_clahe = args.create_clahe
+
     print("-----")
     print(f"Loading data from {data_path}...")
 
     # Run training 
-    run = Run(data_path)
+    run = Run(data_path, clahe=clahe, has_mask=has_mask, create_clahe=create_clahe)
     run.run_training(model_path=model_path)
 
     # Check to see if the model has learned enough
@@ -1,12 +1,154 @@
 import os
+import sys
 import zarr
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import cv2
 import gunpowder as gp
 import numpy as np 
-from skimage import exposure
-from torch.utils.data import Dataset
+import torch
+from numcodecs import Blosc
+from torch.utils.data import Dataset, DataLoader
 
 from config.load_configs import TRAINING_CONFIG
 
+# cuCIM is optional. If it is installed, clahe is computed on the gpu.
+try:
+    import cupy as cp
+    from cucim.skimage import exposure as cu_exposure
+except ImportError:
+    cp = None
+
+@lru_cache(maxsize=None)
+def _create_clahe(tile_grid_size):
+    """
+        Create an OpenCV clahe object, reused for all slices with the same tile grid.
+    """
+    # OpenCV scales the clip limit by the tile area / number of bins (256), so this 
+    # matches the default clip_limit=0.01 of skimage.exposure.equalize_adapthist
+    return cv2.createCLAHE(clipLimit=0.01*256, tileGridSize=tile_grid_size)
+
+def clahe_slice(raw_slice, kernel_size=128):
+    """
+        Apply clahe (Contrast Limited Adaptive Histogram Equalization) to a 2D slice 
+        using OpenCV. 
+
+        Parameters
+        -------------------
+        raw_slice (array):
+            The 2D (y,x) slice to equalise. 
+        kernel_size (int):
+            The size (in voxels) of the contextual regions. Default: 128.
+
+        Returns
+        -------------------
+        clahe_slice (array):
+            The equalised slice as uint8, with values in [0,255].
+    """
+    # OpenCV's tile grid is given as (x,y)
+    tile_grid_size = (max(1, raw_slice.shape[1]//kernel_size), max(1, raw_slice.shape[0]//kernel_size))
+    slice_uint8 = cv2.normalize(raw_slice, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
+    return _create_clahe(tile_grid_size).apply(slice_uint8)
+
+def clahe_slice_gpu(raw_slice, kernel_size=128):
+    """
+        Apply clahe (Contrast Limited Adaptive Histogram Equalization) to a 2D slice 
+        on the gpu, using cuCIM. Requires cupy and cucim to be installed. cuCIM follows 
+        the skimage algorithm rather than OpenCV's, so the result is close to, but not 
+        the same as, clahe_slice.
+
+        Parameters
+        -------------------
+        raw_slice (array):
+            The 2D (y,x) slice to equalise. 
+        kernel_size (int):
+            The size (in voxels) of the contextual regions. Default: 128.
+
+        Returns
+        -------------------
+        clahe_slice (array):
+            The equalised slice as uint8, with values in [0,255].
+    """
+    equalised = cu_exposure.equalize_adapthist(cp.asarray(raw_slice), kernel_size=kernel_size)
+    return cp.asnumpy(cp.rint(equalised*255).astype(cp.uint8))
+
+def _gpu_clahe_available():
+    """
+        Whether cuCIM is installed and a cuda device is available for clahe. 
+    """
+    if cp is None:
+        return False
+    try:
+        return cp.cuda.runtime.getDeviceCount() > 0
+    except cp.cuda.runtime.CUDARuntimeError:
+        return False
+
+@lru_cache(maxsize=8)
+def _open_em(zarr_path):
+    """
+        Open the zarr container at zarr_path for reading. Chunk reads are repeated often 
+        during training and validation, so the store is wrapped in a least recently used 
+        cache of the (compressed) chunk bytes, saving repeated disk reads. The store and group are shared by every EMData instance for 
+        the same path, so rebuilding a pipeline does not reopen the container. 
+
+        Parameters
+        -------------------
+        zarr_path (str):
+            The path to the zarr group. 
+
+        Returns
+        -------------------
+        store (zarr LRUStoreCache):
+            The cached store for the zarr group. 
+        data (zarr group):
+            The zarr group opened in read mode.
+    """
+    # Check if the proviced zarr path is a zarr group
+    if not os.path.exists(os.path.join(zarr_path, '.zgroup')):
+        raise FileNotFoundError(f"{zarr_path} does not contain required '.zgroup' file.")
+
+    store = zarr.LRUStoreCache(zarr.DirectoryStore(zarr_path), max_size=2**30)
+    return store, zarr.open(store, mode = 'r')
+
+def _input_shape_chunks(shape):
+    """
+        Chunks for an array created for training ('target' and 'raw_clahe'), matching the 
+        blocks of TRAINING_CONFIG.input_shape read during training. Capped at the array 
+        shape for small dimensions. 
+    """
+    return tuple(min(int(c), s) for c, s in zip(TRAINING_CONFIG.input_shape, shape))
+
+def _read_z_blocks(array):
+    """
+        Yield the z-slices of a zarr array, reading array.chunks[0] slices at a time 
+        so that each chunk is only decompressed once. 
+    """
+    for z in range(0, array.shape[0], array.chunks[0]):
+        yield from array[z:z + array.chunks[0]]
+
+def _write_z_blocks(array, slices):
+    """
+        Write an iterable of z-slices into a zarr array. The slices are buffered into 
+        blocks of array.chunks[0] slices, so that every chunk is written whole, once. 
+    """
+    block = np.empty((array.chunks[0], *array.shape[1:]), dtype=array.dtype)
+    num_buffered = 0
+
+    for z, array_slice in enumerate(slices):
+        block[num_buffered] = array_slice
+        num_buffered += 1
+
+        if num_buffered == block.shape[0] or z + 1 == array.shape[0]:
+            array[z + 1 - num_buffered:z + 1] = block[:num_buffered]
+            num_buffered = 0
+
+def _to_tensor(array):
+    """
+        Convert a numpy array to a tensor. No copy is made if the array is already 
+        contiguous with native byte order.
+    """
+    array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('='))
+    return torch.from_numpy(array)
 
 class EMData(Dataset):
 
@@ -14,7 +156,8 @@ class EMData(Dataset):
                  zarr_path: str,
                  train_validate_predict: str,
                  has_mask = False,
-                 clahe = False
+                 clahe = False,
+                 create_clahe = None
                  ):
         
         """
@@ -30,6 +173,8 @@ class EMData(Dataset):
                 The type of data. Options: 'train', 'validate' or 'predict'.
             zarr_path (str):
                 Path to the zarr container. 
+            store (zarr LRUStoreCache):
+                The cached store for the zarr group. 
             data (zarr group):
                 The zarr group containing the data.
             raw_data_path (str):
@@ -71,8 +216,12 @@ class EMData(Dataset):
             has_mask (bool):
                 Whether to expect the zarr group to contain mask data. Default: False.
             clahe (bool):
-                Whether to use clahe raw data. If set to True but no clahe zarr array found, will 
-                ask whether to create the clahe array on the fly. Default: False.
+                Whether to use clahe raw data. If set to True but no clahe zarr array found, 
+                create_clahe decides whether to create the clahe array on the fly. Default: False.
+            create_clahe (bool):
+                Whether to create the clahe array if it is missing. If False, the raw data is 
+                used instead. If None, the user is asked when running in a terminal, and the 
+                array is created otherwise (e.g. under nohup or in a script). Default: None.
         """
         
         self.has_mask = has_mask
@@ -86,53 +235,59 @@ class EMData(Dataset):
             # Locate the zarr file and find the paths to different data types
             self.zarr_path = zarr_path
 
-            # Check if the proviced zarr path is a zarr group
-            if '.zgroup' not in os.listdir(self.zarr_path):
-                raise FileNotFoundError(f"{self.zarr_path} does not contain required '.zgroup' file.")
+            # Read in the main zarr folder, shared with any other EMData for the same path
+            self.store, self.data = _open_em(self.zarr_path)
             
-            # Check if the zarr group has the required train/validate/predict folder
-            if self.mode not in os.listdir(self.zarr_path):
-                raise FileNotFoundError(f"{self.zarr_path} does not contain a {self.mode} folder.")
-            
-            # Check if train/validate/predict folder is a zarr group
-            if '.zgroup' not in os.listdir(self.zarr_path + "/" + self.mode):
+            # Check if train/validate/predict folder is a zarr group. The store caches its
+            # keys, so the filesystem is only checked again to explain a failure.
+            if f"{self.mode}/.zgroup" not in self.store:
+                # Check if the zarr group has the required train/validate/predict folder
+                if not os.path.isdir(os.path.join(self.zarr_path, self.mode)):
+                    raise FileNotFoundError(f"{self.zarr_path} does not contain a {self.mode} folder.")
                 raise FileNotFoundError(f"{self.zarr_path + "/" + self.mode} does not contain required '.zgroup' file.")
 
-            # Read in the main zarr folder
-            self.data = zarr.open(self.zarr_path, mode = 'r')
+            group = self.data[self.mode]
 
             # Locate correct raw data and assign
             if clahe:
-                if 'raw_clahe' in os.listdir(self.zarr_path + "/" + self.mode):
+                if 'raw_clahe' in group:
                     self.raw_data_path = f"/{self.mode}/raw_clahe"
-                    self.raw_data = self.data[self.mode]["raw_clahe"]
+                    self.raw_data = group["raw_clahe"]
                 else:
-                    make_clahe = input(f"'raw_clahe' file not found in {self.zarr_path}/{self.mode}. Would you like to create a clahe file? (y/n) ")
-                    if make_clahe.lower() == 'y':
+                    # Only ask when there is a user to answer
+                    if create_clahe is None:
+                        if sys.stdin is not None and sys.stdin.isatty():
+                            make_clahe = input(f"'raw_clahe' file not found in {self.zarr_path}/{self.mode}. Would you like to create a clahe file? (y/n) ")
+                            create_clahe = make_clahe.lower() == 'y'
+                        else:
+                            print(f"'raw_clahe' file not found in {self.zarr_path}/{self.mode}. Creating clahe file.")
+                            create_clahe = True
+
+                    if create_clahe:
                         self.create_clahe()
                         self.raw_data_path = f"/{self.mode}/raw_clahe"
-                        self.raw_data = self.data[self.mode]["raw_clahe"]
+                        self.raw_data = group["raw_clahe"]
                     else:
                         self.raw_data_path = f"/{self.mode}/raw"
-                        self.raw_data = self.data[self.mode]["raw"]
+                        self.raw_data = group["raw"]
             else:
                 self.raw_data_path = f"/{self.mode}/raw"
-                self.raw_data = self.data[self.mode]["raw"]
+                self.raw_data = group["raw"]
 
             # If train or validate, assign ground-truth data
             if self.mode == "train" or self.mode == "validate":
 
-                if 'gt' not in os.listdir(self.zarr_path + "/" + self.mode):
+                if 'gt' not in group:
                     raise FileNotFoundError(f"Ground-truth file is missing in {self.zarr_path}/{self.mode}")
                 
                 self.gt_data_path = f"/{self.mode}/gt"
-                self.gt_data = self.data[self.mode]["gt"]
+                self.gt_data = group["gt"]
 
                 # Check if target folder exists and assign target_data_path and target_data
-                if 'target' in os.listdir(self.zarr_path + "/" + self.mode):
+                if 'target' in group:
                     self.has_target = True
                     self.target_data_path = f"/{self.mode}/target"
-                    self.target_data = self.data[self.mode]["target"]
+                    self.target_data = group["target"]
                     # Check to see if the target data is at least as big as the input shape
                     if self.target_data.shape < TRAINING_CONFIG.input_shape:
                         self.has_target = False
@@ -141,14 +296,14 @@ class EMData(Dataset):
 
                 # Check if the data has a mask
                 if self.has_mask:
-                    if 'mask' in os.listdir(self.zarr_path + "/" + self.mode):
+                    if 'mask' in group:
                         self.mask_data_path = f"/{self.mode}/mask"
-                        self.mask_data = self.data[self.mode]["mask"]
+                        self.mask_data = group["mask"]
                     else:
                         raise FileNotFoundError(f"Mask file is missing in {self.zarr_path}/{self.mode}")
 
             # Check raw data has zarr attributes
-            if ".zattrs" in os.listdir(self.zarr_path + self.raw_data_path):
+            if len(self.raw_data.attrs) > 0:
 
                 # Check raw data has resolution attribute
                 if "resolution" in self.raw_data.attrs:
@@ -166,7 +321,7 @@ class EMData(Dataset):
 
                 # Check whether raw and gt data have same attributes
                 if self.mode == "train" or self.mode == "validate":
-                    if ".zattrs" in os.listdir(self.zarr_path + self.gt_data_path):
+                    if len(self.gt_data.attrs) > 0:
                         for atr in self.raw_data.attrs:
                             if atr in self.gt_data.attrs:
                                 if self.raw_data.attrs[atr] != self.gt_data.attrs[atr]:
@@ -184,18 +339,19 @@ class EMData(Dataset):
         
     def __len__(self):
         """ 
-            Returns the length of the raw data shape 
+            Returns the number of samples, i.e. the number of z-slices of the raw data 
         """
-        return len(self.raw_data.shape)
+        return self.raw_data.shape[0]
 
     def __getitem__(self, index):
         """ 
-            Returns a dictionary containing the raw and ground truth data at index.
+            Returns a dictionary containing the raw and ground truth data at index. The data 
+            is returned as tensors, so that the DataLoader can place it in pinned memory.
         """
 
         if self.mode == "predict":
             raw_data = self.raw_data[index]
-            return {"raw": raw_data}
+            return {"raw": _to_tensor(raw_data)}
 
         else:
             # Load the raw and ground truth data
@@ -203,7 +359,7 @@ class EMData(Dataset):
             gt_data = self.gt_data[index]
 
             # Return a dictionary containing data
-            return {"raw": raw_data, "gt": gt_data}
+            return {"raw": _to_tensor(raw_data), "gt": _to_tensor(gt_data)}
         
     def create_target(self, data_type = 'int64'):
         """ 
@@ -219,33 +375,34 @@ class EMData(Dataset):
         # Open the zarr file in read and write mode
         f = zarr.open(self.zarr_path + "/" + self.mode , mode='r+')
 
-        # change data type of gt
-        gt = f['gt'].astype(data_type)
-
-        # Check if the gt data is at least as big as the input shape for the model
-        if gt.shape < TRAINING_CONFIG.input_shape:
-    
-            diff_z = TRAINING_CONFIG.input_shape[0] - gt.shape[0]
-            diff_y = TRAINING_CONFIG.input_shape[1] - gt.shape[1]
-            diff_x = TRAINING_CONFIG.input_shape[2] - gt.shape[2]
-
-            # Account for dimesions with gt.shape[i] > input_shape[i]
-            if diff_z < 0:
-                diff_z = 0
-            if diff_y < 0:
-                diff_y =0
-            if diff_x <0:
-                diff_x = 0 
-
-            # Pad gt to account for difference between input shape
-            gt = np.pad(gt, ((0, diff_z), (0, diff_y), (0, diff_x)), 'constant')
-
-        # Create target zarr array
-        f['target'] = gt
+        gt = f['gt']
+
+        # The target must be at least as big as the input shape for the model in every 
+        # dimension. Any padding is given by the zero fill value of the target array.
+        target_shape = tuple(max(s, int(i)) for s, i in zip(gt.shape, TRAINING_CONFIG.input_shape))
+
+        # Create target zarr array, chunked to match the blocks read during training
+        chunks = _input_shape_chunks(target_shape)
+        target = f.create_dataset(
+                                'target', 
+                                shape = target_shape, 
+                                chunks = chunks, 
+                                dtype = data_type, 
+                                fill_value = 0, 
+                                overwrite = True
+                                )
+
+        # Stream gt into target one chunk-aligned block of z-slices at a time, changing the 
+        # data type as it goes, so the full volume is never held in memory
+        for z in range(0, gt.shape[0], chunks[0]):
+            z_end = min(z + chunks[0], gt.shape[0])
+            target[z:z_end, :gt.shape[1], :gt.shape[2]] = gt[z:z_end].astype(data_type)
         
-        # Copy over attributes from gt to target
-        for atr in f['gt'].attrs:
-            f['target'].attrs[atr] = f['gt'].attrs[atr]
+        # Copy over attributes from gt to target in a single write
+        target.attrs.update(gt.attrs.asdict())
+
+        # Clear the cache so the new array is visible
+        self.store.invalidate()
         
         self.target_data_path = f"/{self.mode}/target"
         self.target_data = self.data[self.mode]["target"]
@@ -253,14 +410,67 @@ class EMData(Dataset):
 
     def create_clahe(self):
         """
-            Create a clahe version of the raw data.
+            Create a clahe version of the raw data. If cuCIM is installed and a gpu is 
+            available the slices are equalised on the gpu, otherwise the z-slices are 
+            processed in parallel across the cpu cores using OpenCV. The result is 
+            stored as uint8, with a 'scale' attribute of 1/255 to recover values 
+            in [0,1]; gp.Normalize applies this scaling automatically for uint8 data.
         """
         f = zarr.open(self.zarr_path + "/" + self.mode , mode='r+')
-        raw = f['raw'] 
-        raw_clahe = np.array([
-                    exposure.equalize_adapthist(raw[z], kernel_size=128)
-                    for z in range(raw.shape[0])
-                ], dtype=np.float32)
-        f['raw_clahe'] = raw_clahe
-        for atr in f['raw'].attrs:
-            f['raw_clahe'].attrs[atr] = f['raw'].attrs[atr]
\ No newline at end of file
+
+        raw = f['raw']
+
+        # Chunk to match the blocks read during training, as raw_clahe replaces raw 
+        # when clahe is used. Bit-shuffling compresses uint8 well.
+        raw_clahe = f.create_dataset(
+                                    'raw_clahe', 
+                                    shape = raw.shape,
+                                    dtype = 'u1',
+                                    chunks = _input_shape_chunks(raw.shape),
+                                    compressor = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE),
+                                    overwrite = True
+                                    )
+
+        # The slices are written one block of chunks at a time as they are equalised, so 
+        # the full clahe volume is never held in memory
+        if _gpu_clahe_available():
+            # Raw is read one block of chunks at a time, and its slices equalised in turn
+            _write_z_blocks(raw_clahe, (clahe_slice_gpu(raw_slice) for raw_slice in _read_z_blocks(raw)))
+        else:
+            # OpenCV is limited to a single thread per worker, as the slices are already parallelised.
+            # The raw data is read into memory once, so the workers are sent numpy slices.
+            with ProcessPoolExecutor(initializer=cv2.setNumThreads, initargs=(1,)) as executor:
+                _write_z_blocks(raw_clahe, executor.map(clahe_slice, raw[:]))
+
+        # Copy over attributes from raw in a single write, along with the scale
+        raw_clahe.attrs.update({**raw.attrs.asdict(), 'scale': 1/255})
+
+        # Clear the cache so the new array is visible
+        self.store.invalidate()
+
+    def get_dataloader(self, batch_size = 1, shuffle = True, num_workers = 4, prefetch_factor = 4):
+        """
+            Returns a torch DataLoader for this dataset. Workers are kept alive between 
+            epochs and prefetch samples ahead of time. Batches are placed in pinned memory 
+            when cuda is available, allowing asynchronous copies to the gpu.
+
+            Parameters
+            -------------------
+            batch_size (int):
+                The number of samples per batch. Default: 1.
+            shuffle (bool):
+                Whether to shuffle the samples. Default: True.
+            num_workers (int):
+                The number of worker processes used for loading. Default: 4.
+            prefetch_factor (int):
+                The number of batches each worker loads in advance. Default: 4.
+        """
+        return DataLoader(
+                        self,
+                        batch_size = batch_size,
+                        shuffle = shuffle,
+                        num_workers = num_workers,
+                        pin_memory = torch.cuda.is_available(),
+                        persistent_workers = num_workers > 0,
+                        prefetch_factor = prefetch_factor if num_workers > 0 else None
+                        )
\ No newline at end of file
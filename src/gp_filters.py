@@ -1,5 +1,6 @@
 import numpy as np
 import gunpowder as gp
+import torch
 
 class AddChannelDim(gp.BatchFilter):
 
@@ -35,3 +36,49 @@ class RemoveChannelDim(gp.BatchFilter):
             return
 
         batch[self.array].data = batch[self.array].data[0]
+
+class InferencePredict(gp.torch.Predict):
+    """
+        gp.torch.Predict that runs the forward pass in torch.inference_mode, which also 
+        skips the autograd version counter bookkeeping that no_grad keeps. On cuda, cudnn 
+        benchmarks the convolution algorithms for the fixed tile shape while the node is 
+        running (the previous setting is restored on stop, so training is unaffected), and 
+        the model can optionally be converted to the channels_last_3d memory format. 
+
+        Parameters
+        -------------------
+        channels_last (bool):
+            Whether to convert the model to channels_last_3d on cuda. This changes the 
+            layout of the model parameters, so should not be used on a model that is 
+            still being trained. Default: False.
+        
+        All other arguments are passed to gp.torch.Predict.
+    """
+
+    def __init__(self, *args, channels_last = False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.channels_last = channels_last
+        self.previous_cudnn_benchmark = None
+
+    def start(self):
+        super().start()
+
+        if self.use_cuda:
+            self.previous_cudnn_benchmark = torch.backends.cudnn.benchmark
+            torch.backends.cudnn.benchmark = True
+            if self.channels_last:
+                self.model.to(memory_format=torch.channels_last_3d)
+
+    def stop(self):
+        # Restore the global cudnn setting, e.g. for training after a validation run
+        if self.previous_cudnn_benchmark is not None:
+            torch.backends.cudnn.benchmark = self.previous_cudnn_benchmark
+            self.previous_cudnn_benchmark = None
+        super().stop()
+
+    def predict(self, batch, request):
+        inputs = self.get_inputs(batch)
+        with torch.inference_mode():
+            out = self.model(**inputs)
+        outputs = self.get_outputs(out, request)
+        self.update_batch(batch, request, outputs)
@@ -13,7 +13,8 @@ class DetectionModel(torch.nn.Module):
                 fmap_inc_factor = MODEL_CONFIG.fmap_inc_factors,
                 downsample_factors = MODEL_CONFIG.downsample_factors,
                 padding = MODEL_CONFIG.padding,
-                constant_upsample = MODEL_CONFIG.constant_upsample
+                constant_upsample = MODEL_CONFIG.constant_upsample,
+                mixed_precision = MODEL_CONFIG.mixed_precision
                 ):
         
         """
@@ -48,6 +49,9 @@ class DetectionModel(torch.nn.Module):
                 Controls upsampling layers in the UNet. If true, will perform a constant 
                 upsampling instead of a transposed convolution. Default set using 
                 model_config.yaml file.
+            mixed_precision (bool):
+                Whether to run the forward pass in bfloat16 autocast. Only applied on 
+                CUDA devices that support bfloat16. Default set using model_config.yaml file.
         """
         
         super(DetectionModel,self).__init__()
@@ -57,6 +61,7 @@ class DetectionModel(torch.nn.Module):
         dims = len(downsample_factors[0])
 
         self.downsample_factors = downsample_factors
+        self.mixed_precision = mixed_precision and torch.cuda.is_available() and torch.cuda.is_bf16_supported()
 
         # Check for isotropic vs non-isotropic data
         # Assumptions: 
@@ -97,8 +102,66 @@ class DetectionModel(torch.nn.Module):
                     )
 
     def forward(self, x):
-        x = self.total_model(x)
-        return x
+        # Match the input to the weights, which may have been cast to bfloat16 for prediction
+        x = x.to(next(self.parameters()).dtype)
+        with torch.autocast(device_type=x.device.type, dtype=torch.bfloat16, enabled=self.mixed_precision and x.is_cuda):
+            x = self.total_model(x)
+        # Return float32 so the loss and softmax are computed at full precision
+        return x.float()
+
+def compile_model(model, input_shape, device, mode = 'default', training = False):
+    """
+        Compile a model in place with torch.compile, falling back to eager mode if 
+        compiling fails. Compiling in place keeps the state_dict keys unchanged, so 
+        checkpoints still load into an uncompiled model. Compilation only happens on the 
+        first forward pass, so a warm-up pass is run on a dummy input to surface any 
+        failure here rather than part way through training or prediction. 
+
+        Parameters
+        -------------------
+        model (DetectionModel):
+            The model to compile. It is moved to device. 
+        input_shape (tuple):
+            The shape (in voxels) of the model input, used for the warm-up pass. 
+        device (torch.device):
+            The device to run the warm-up pass on. 
+        mode (str):
+            The torch.compile mode. Default: 'default'.
+        training (bool):
+            Whether the model will be trained, in which case the warm-up also runs a 
+            backward pass. Otherwise it runs in inference mode. Default: False.
+
+        Returns
+        -------------------
+        compiled (bool):
+            Whether the model was compiled. 
+    """
+    was_training = model.training
+    model.to(device)
+
+    try:
+        model.compile(mode=mode)
+        dummy_input = torch.zeros((1, 1, *input_shape), device=device)
+        model.train(training)
+        if training:
+            model(dummy_input).sum().backward()
+            model.zero_grad(set_to_none=True)
+        else:
+            with torch.inference_mode():
+                model(dummy_input)
+    except Exception as e:
+        # Restore eager mode
+        model._compiled_call_impl = None
+        model.zero_grad(set_to_none=True)
+        print(f"Could not compile model, continuing in eager mode: {e}")
+        return False
+    finally:
+        model.train(was_training)
+
+    # Later recompilations (e.g. for validation in eval mode) also fall back to eager 
+    # mode rather than aborting the run
+    torch._dynamo.config.suppress_errors = True
+    return True
     
 def UnetOutputShape(
                     model: DetectionModel,
@@ -1,7 +1,25 @@
 import numpy as np
+import warnings
 import zarr
 import funlib.evaluate
 
+# Largest label value for which the labels are found by counting rather than sorting
+MAX_BINCOUNT_LABEL = 2**16
+
+def _label_ids(gt_data):
+    """
+        Find the labels present in a ground truth volume. For small, non-negative 
+        integer labels this is a single counting pass; otherwise fall back to np.unique.
+    """
+    if gt_data.size == 0:
+        return np.empty(0, dtype=np.int32)
+
+    if np.issubdtype(gt_data.dtype, np.integer) and gt_data.min() >= 0 and gt_data.max() <= MAX_BINCOUNT_LABEL:
+        counts = np.bincount(gt_data.ravel())
+        return np.flatnonzero(counts).astype(np.int32)
+
+    return np.unique(gt_data).astype(np.int32)
+
 def score_prediction(pred,
                     target, 
                     matching_score = 'overlap', 
@@ -39,30 +57,18 @@ def score_prediction(pred,
     background_label = target.attrs['background_label']
 
     # Find the size difference between target and prediction
-    if target.shape != pred.shape:
-        border = [
-                int((target.shape[0] - pred.shape[0])/2), 
-                int((target.shape[1] - pred.shape[1])/2), 
-                int((target.shape[2] - pred.shape[2])/2)
-                ]
-        # trim target to match prediction
-        gt_data = target[
-                        border[0]:-1*border[0],
-                        border[1]:-1*border[1],
-                        border[2]:-1*border[2],
-                        ]
-    else:
-        gt_data = target[:,:,:]
+    border = [int((target.shape[i] - pred.shape[i])/2) for i in range(3)]
+
+    # Trim target to match prediction with a single sliced read, so only the 
+    # chunks overlapping the prediction are fetched
+    trim = tuple(slice(border[i], target.shape[i] - border[i]) for i in range(3))
+    gt_data = target[trim]
     
-    pred_data = pred[:,:,:]
+    pred_data = pred[...]
 
-    label_ids = np.unique(gt_data).astype(np.int32)
+    label_ids = _label_ids(gt_data)
     scores = dict()
 
-    precision_total = 0.0 
-    recall_total = 0.0 
-    fscore_total = 0.0
-
     # Remove background label from scoring
     if background_label is not None:
         label_ids = label_ids[label_ids != background_label]
@@ -77,44 +83,32 @@ def score_prediction(pred,
                                                         return_matches=return_results
                                                         )
 
-    for label in label_ids:
-
-        tp = detection_scores[f'tp_{label}']
-        fp = detection_scores[f'fp_{label}']
-        fn = detection_scores[f'fn_{label}']
-
-        num_predicted = tp + fp 
-        num_relevant = tp + fn
-
-        if num_predicted > 0:
-            precision = tp/num_predicted
-        else:
-            precision = np.nan 
-
-        if num_relevant > 0:
-            recall = tp/num_relevant
-        else: 
-            recall = np.nan 
+    # Compute the scores for all labels at once
+    tp = np.array([detection_scores[f'tp_{label}'] for label in label_ids], dtype=np.float64)
+    fp = np.array([detection_scores[f'fp_{label}'] for label in label_ids], dtype=np.float64)
+    fn = np.array([detection_scores[f'fn_{label}'] for label in label_ids], dtype=np.float64)
 
-        if precision + recall > 0:
-            fscore = 2*(precision * recall)/(precision + recall)
-        else:
-            fscore = np.nan
+    num_predicted = tp + fp 
+    num_relevant = tp + fn
 
-        # Store scores for individual label
-        scores[f'precision_{label}'] = precision
-        scores[f'recall_{label}'] = recall
-        scores[f'fscore_{label}'] = fscore 
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(num_predicted > 0, tp/num_predicted, np.nan)
+        recall = np.where(num_relevant > 0, tp/num_relevant, np.nan)
+        fscore = np.where(precision + recall > 0, 2*(precision * recall)/(precision + recall), np.nan)
 
-        # Update total scores
-        precision_total += precision
-        recall_total += recall 
-        fscore_total += fscore
+    # Store scores for individual label
+    for label, label_precision, label_recall, label_fscore in zip(label_ids.tolist(), precision.tolist(), recall.tolist(), fscore.tolist()):
+        scores[f'precision_{label}'] = label_precision
+        scores[f'recall_{label}'] = label_recall
+        scores[f'fscore_{label}'] = label_fscore 
 
+    # Average over the labels with a defined score
     if label_ids.size >= 1:
-        scores['precision_average'] = precision_total/label_ids.size
-        scores['recall_average'] = recall_total/label_ids.size
-        scores['fscore_average'] = fscore_total/label_ids.size
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            scores['precision_average'] = float(np.nanmean(precision))
+            scores['recall_average'] = float(np.nanmean(recall))
+            scores['fscore_average'] = float(np.nanmean(fscore))
 
     return scores 
 
@@ -1,6 +1,8 @@
+import itertools
+import torch
 import gunpowder as gp 
 
-from src.gp_filters import AddChannelDim, RemoveChannelDim, TransposeDims
+from src.gp_filters import AddChannelDim, RemoveChannelDim, TransposeDims, InferencePredict
 from src.data_loader import EMData
 from src.model.model import DetectionModel
 from src.model.model import UnetOutputShape
@@ -11,7 +13,8 @@ class Prediction:
                 data: EMData,
                 model: DetectionModel,
                 input_shape: tuple,
-                checkpoint = None):
+                checkpoint = None,
+                channels_last = False):
         """
             Class for vesicle predicition. 
 
@@ -23,6 +26,9 @@ class Prediction:
                 The model used for prediction. 
             checkpoint:
                 The checkpoint of a trained model (optional). 
+            channels_last:
+                Whether to convert the model to the channels_last_3d memory format on cuda. 
+                Only use for a model that is no longer being trained. Default: False.
             voxel_size: 
                 The voxel size of the data. 
             input_shape:
@@ -48,6 +54,7 @@ class Prediction:
         self.data = data
         self.detection_model = model
         self.checkpoint = checkpoint
+        self.channels_last = channels_last
         self.voxel_size = self.data.voxel_size
         self.input_shape = input_shape
 
@@ -69,23 +76,10 @@ class Prediction:
         self.output_shape = output_shape
         self.border = border
 
-        # Obtain shape for prediciton
-        if self.input_shape[0] >= self.data.raw_data.shape[0]:
-            predict_shape_z = self.input_shape[0]
-        else:
-            predict_shape_z = self.data.raw_data.shape[0]
-        
-        if self.input_shape[1] >= self.data.raw_data.shape[1]:
-            predict_shape_y = self.input_shape[1]
-        else:
-            predict_shape_y = self.data.raw_data.shape[1]
-
-        if self.input_shape[2] >= self.data.raw_data.shape[2]:
-            predict_shape_x = self.input_shape[2]
-        else:
-            predict_shape_x = self.data.raw_data.shape[2]
-
-        self.predict_shape = (predict_shape_z, predict_shape_y, predict_shape_x)
+        # Obtain shape for prediciton: at least the input shape in every (z,y,x) dimension
+        self.predict_shape = tuple(
+                                int(max(i, r)) for i, r in zip(self.input_shape, self.data.raw_data.shape[-3:])
+                                )
 
         # Switch to world units for use with gunpowder
         input_shape = gp.Coordinate(self.input_shape)
@@ -97,31 +91,25 @@ class Prediction:
         self.predict_size = self.data.voxel_size * predict_shape
         self.border_size = self.data.voxel_size * border_shape
 
-    def predict_pipeline(self):
-
+    def _build_pipeline(self):
         """
-            Predicition pipeline for vesicle detection. Input image is 
-            broken down using gunpowder and predictions are done in tiles, 
-            corresponding to the model's trained input size. These individual 
-            prediction tiles are then sewn together to give a full predicition.
+            Build the gunpowder pipeline that predicts on a single tile, corresponding 
+            to the model's trained input size. 
 
             Returns 
             -------------------
-            ret (dict):
-                A dictionary containing two gunpowder arrays, 'raw' and 'prediction'. 
+            pipeline (gunpowder pipeline):
+                The tile prediction pipeline. 
+            raw (gunpowder ArrayKey):
+                The key for the raw data. 
+            prediction (gunpowder ArrayKey):
+                The key for the prediction. 
         """
-    
-        self.detection_model.eval()
 
         # Define the gunpowder arrays
         raw = gp.ArrayKey('RAW')
         prediction = gp.ArrayKey('PREDICTION')
 
-        # Create scan request (i.e. where each prediction will happen)
-        scan_request = gp.BatchRequest()
-        scan_request.add(raw, self.input_size)
-        scan_request.add(prediction, self.output_size)
-
         # Create the source node for pipeline
         source = gp.ZarrSource(
                 self.data.zarr_path,
@@ -146,11 +134,12 @@ class Prediction:
         # This accounts for us having a batch with size 1
         pipeline += AddChannelDim(raw)
 
-        pipeline += gp.torch.Predict(
+        pipeline += InferencePredict(
                 model=self.detection_model,
                 checkpoint = self.checkpoint, 
                 inputs={'x': raw},
-                outputs={0: prediction}
+                outputs={0: prediction},
+                channels_last = self.channels_last
                 )
         
         # Remove the created batch dimension
@@ -160,6 +149,31 @@ class Prediction:
         if self.channel_dims == 0:
             pipeline += RemoveChannelDim(raw)
 
+        return pipeline, raw, prediction
+
+    def predict_pipeline(self):
+
+        """
+            Predicition pipeline for vesicle detection. Input image is 
+            broken down using gunpowder and predictions are done in tiles, 
+            corresponding to the model's trained input size. These individual 
+            prediction tiles are then sewn together to give a full predicition.
+
+            Returns 
+            -------------------
+            ret (dict):
+                A dictionary containing two gunpowder arrays, 'raw' and 'prediction'. 
+        """
+    
+        self.detection_model.eval()
+
+        pipeline, raw, prediction = self._build_pipeline()
+
+        # Create scan request (i.e. where each prediction will happen)
+        scan_request = gp.BatchRequest()
+        scan_request.add(raw, self.input_size)
+        scan_request.add(prediction, self.output_size)
+
         pipeline += gp.Scan(scan_request)
 
         total_request = gp.BatchRequest()
@@ -180,6 +194,75 @@ class Prediction:
                     'prediction': batch[prediction]
                 }
         return ret
+
+    def predict_to_zarr(self, zarr_group, dataset_name):
+        """
+            Predicition for vesicle detection that converts each tile into probabilities 
+            (softmax over the channels) and writes it straight into a zarr array, rather 
+            than sewing the tiles together in memory. Only a single tile is held in memory 
+            while predicting. The tiles are placed in the same way as by gp.Scan in 
+            predict_pipeline, with the last tile in each dimension shifted back to end at 
+            the prediction edge. 
+
+            Parameters
+            -------------------
+            zarr_group (zarr group):
+                The zarr group, opened in write mode, to save the probabilities in. 
+            dataset_name (str):
+                The name of the zarr array to create within zarr_group. If it already 
+                exists, it will be overwritten. 
+
+            Returns 
+            -------------------
+            prediction_array (zarr array):
+                The probabilities, with shape (channels, z, y, x) where (z, y, x) is the 
+                prediction shape. Chunks match the model's output shape. 
+        """
+
+        self.detection_model.eval()
+
+        pipeline, raw, prediction = self._build_pipeline()
+
+        # Tile offsets (in physical units) for each dimension, snapping the last tile 
+        # so that it does not overshoot the prediction 
+        tile_offsets = [
+                        sorted({min(offset, predict - output) for offset in range(0, predict, output)})
+                        for predict, output in zip(self.predict_size, self.output_size)
+                        ]
+
+        prediction_array = None
+
+        with gp.build(pipeline):
+            for offset in itertools.product(*tile_offsets):
+                offset = gp.Coordinate(offset)
+
+                # The raw tile is offset by -1*border_size so the prediction covers the raw data exactly
+                request = gp.BatchRequest()
+                request[raw] = gp.Roi(offset=offset - self.border_size, shape=self.input_size)
+                request[prediction] = gp.Roi(offset=offset, shape=self.output_size)
+
+                tile = pipeline.request_batch(request)[prediction].data
+                tile = torch.softmax(torch.from_numpy(tile), dim=0).numpy()
+
+                # Create the output once the number of prediction channels is known
+                if prediction_array is None:
+                    prediction_array = zarr_group.create_dataset(
+                                                                dataset_name, 
+                                                                shape = (tile.shape[0], *self.predict_shape), 
+                                                                chunks = (tile.shape[0], *self.output_shape),
+                                                                dtype = 'f4',
+                                                                overwrite = True
+                                                                )
+                
+                start = offset / self.voxel_size
+                prediction_array[
+                                :,
+                                start[0]:start[0] + self.output_shape[0],
+                                start[1]:start[1] + self.output_shape[1],
+                                start[2]:start[2] + self.output_shape[2]
+                                ] = tile
+
+        return prediction_array
     
     def print_border_message(self):
         print("-----"*5)
@@ -1,5 +1,6 @@
 import os
 import torch
+import numpy as np
 import gunpowder as gp
 from datetime import datetime
 
@@ -14,7 +15,8 @@ class Training():
                 zarr_path: str,
                 clahe = TRAINING_CONFIG.clahe,
                 training_has_mask = TRAINING_CONFIG.has_mask,
-                input_shape = TRAINING_CONFIG.input_shape
+                input_shape = TRAINING_CONFIG.input_shape,
+                create_clahe = None
                 ):
         """
             Class for training a vesicle detection model. 
@@ -61,8 +63,8 @@ class Training():
           
         # Load in the data and create target arrays
         self.zarr_path = zarr_path
-        self.training_data = EMData(self.zarr_path, "train", clahe=clahe, has_mask = training_has_mask)
-        self.validate_data = EMData(self.zarr_path, "validate", clahe=clahe)
+        self.training_data = EMData(self.zarr_path, "train", clahe=clahe, has_mask = training_has_mask, create_clahe = create_clahe)
+        self.validate_data = EMData(self.zarr_path, "validate", clahe=clahe, create_clahe = create_clahe)
         if not self.training_data.has_target:
             self.training_data.create_target()
         if not self.validate_data.has_target:
@@ -94,23 +96,10 @@ class Training():
         self.output_shape = output_shape
         self.border = border
 
-        # Obtain shape for prediciton
-        if self.input_shape[0] >= self.validate_data.raw_data.shape[0]:
-            predict_shape_z = self.input_shape[0]
-        else:
-            predict_shape_z = self.validate_data.raw_data.shape[0]
-        
-        if self.input_shape[1] >= self.validate_data.raw_data.shape[1]:
-            predict_shape_y = self.input_shape[1]
-        else:
-            predict_shape_y = self.validate_data.raw_data.shape[1]
-
-        if self.input_shape[2] >= self.validate_data.raw_data.shape[2]:
-            predict_shape_x = self.input_shape[2]
-        else:
-            predict_shape_x = self.validate_data.raw_data.shape[2]
-
-        self.predict_shape = (predict_shape_z, predict_shape_y, predict_shape_x)
+        # Obtain shape for prediciton: at least the input shape in every (z,y,x) dimension
+        self.predict_shape = tuple(
+                                int(max(i, r)) for i, r in zip(self.input_shape, self.validate_data.raw_data.shape[-3:])
+                                )
 
         # Switch to world units for use with gunpowder
         input_shape = gp.Coordinate(self.input_shape)
@@ -139,7 +128,9 @@ class Training():
                 self,
                 augmentations = TRAINING_CONFIG.augmentations,
                 batch_size = TRAINING_CONFIG.batch_size,
-                snapshot_every = TRAINING_CONFIG.snapshot_every
+                snapshot_every = TRAINING_CONFIG.snapshot_every,
+                cache_size = None,
+                num_workers = 1
                 ):
         
         """
@@ -155,6 +146,12 @@ class Training():
                 Default set using training_config.yaml. 
             snapshot_every (int):
                 To be completed.
+            cache_size (int):
+                The number of augmented samples to keep ready in the pre-cache. Default is 
+                4*batch_size.
+            num_workers (int):
+                The number of worker processes used to pre-compute augmented samples, so that 
+                data loading and augmentation overlap with training. Default: 1.
 
             Returns 
             -------------------
@@ -233,6 +230,12 @@ class Training():
         if self.channel_dims == 0:
             pipeline += AddChannelDim(raw)
 
+        # Pre-compute augmented samples in background workers, so that reading 
+        # and augmenting data overlaps with the training step.
+        if cache_size is None:
+            cache_size = 4*batch_size
+        pipeline += gp.PreCache(cache_size=cache_size, num_workers=num_workers)
+
         pipeline += gp.Stack(batch_size)
 
         pipeline += gp.torch.Train(
@@ -258,24 +261,54 @@ class Training():
 
 class TrainingStatistics:
 
-    def __init__(self):
+    __slots__ = ('_iterations', '_losses', '_times', '_size')
+
+    def __init__(self, capacity = TRAINING_CONFIG.iterations + 1):
         """
-            Class to store statistics of a training run. 
+            Class to store statistics of a training run. Statistics are stored in 
+            preallocated numpy arrays, which are grown if capacity is exceeded. 
 
             Attributes
             -------------------
             iterations:
-                List containing the iteration numbers of stored statistics.
-            loss:
+                Array containing the iteration numbers of stored statistics.
+            losses:
                 The loss of the iteration. 
             times:
                 The time taken for that training run. 
+
+            Parameters
+            -------------------
+            capacity (int):
+                The number of statistics to allocate space for. Default is the number of 
+                training iterations (plus the final statistic) set by training_config.yaml.
         """
-        self.iterations = []
-        self.losses = []
-        self.times = []
+        self._iterations = np.empty(capacity, dtype=np.int64)
+        self._losses = np.empty(capacity, dtype=np.float32)
+        self._times = np.empty(capacity, dtype=np.float32)
+        self._size = 0
+
+    @property
+    def iterations(self):
+        return self._iterations[:self._size]
+
+    @property
+    def losses(self):
+        return self._losses[:self._size]
+
+    @property
+    def times(self):
+        return self._times[:self._size]
 
     def add_stats(self, iteration, loss, time):
-        self.iterations.append(iteration)
-        self.losses.append(loss)
-        self.times.append(time) 
\ No newline at end of file
+        if self._size == self._iterations.size:
+            # Double the storage if capacity has been reached
+            extra = max(1, self._size)
+            self._iterations = np.concatenate([self._iterations, np.empty(extra, dtype=np.int64)])
+            self._losses = np.concatenate([self._losses, np.empty(extra, dtype=np.float32)])
+            self._times = np.concatenate([self._times, np.empty(extra, dtype=np.float32)])
+
+        self._iterations[self._size] = iteration
+        self._losses[self._size] = loss
+        self._times[self._size] = time
+        self._size += 1
\ No newline at end of file
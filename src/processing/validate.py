@@ -35,10 +35,58 @@ class Validations:
         self.candidates = candidates
         self.loss = loss
 
+def prediction_probabilities(prediction_data, buffers=None):
+    """
+        Convert the model output into probabilities by applying a softmax over the 
+        channel axis. Runs on the gpu when available. 
+
+        Parameters
+        -------------------
+        prediction_data (array):
+            The model output, with shape (channels, z, y, x).
+        buffers (dict):
+            Optional dictionary used to store a device buffer and a (pinned) host buffer.
+            These are created on first use and reused while the prediction shape stays
+            the same, avoiding new allocations on repeated calls. Note that the returned 
+            array is then a view of the host buffer, and will be overwritten by the next 
+            call. Default: None.
+
+        Returns
+        -------------------
+        probs (array):
+            The probabilities, with the same shape as prediction_data.
+    """
+
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
+    logits_host = torch.from_numpy(np.ascontiguousarray(prediction_data, dtype=np.float32))
+
+    if buffers is None:
+        return torch.softmax(logits_host.to(device), dim=0).cpu().numpy()
+
+    if buffers.get('logits') is None or buffers['logits'].shape != logits_host.shape:
+        buffers['logits'] = torch.empty(logits_host.shape, dtype=torch.float32, device=device)
+        buffers['probs'] = torch.empty(logits_host.shape, dtype=torch.float32, pin_memory=use_cuda)
+
+    logits = buffers['logits']
+    probs = buffers['probs']
+
+    # Numerically stable softmax, computed in place
+    logits.copy_(logits_host, non_blocking=True)
+    logits.sub_(logits.amax(dim=0, keepdim=True)).exp_()
+    logits.div_(logits.sum(dim=0, keepdim=True))
+    probs.copy_(logits, non_blocking=True)
+
+    if use_cuda:
+        torch.cuda.synchronize()
+
+    return probs.numpy()
+
 def validate(
             validation_data: EMData, 
             model: DetectionModel,
-            input_shape
+            input_shape,
+            buffers = None
             ):
     """
         Process for running a validation run. 
@@ -53,6 +101,9 @@ def validate(
         input_shape:
             The input shape to be used with the model. Should match the input shape
             of the training run. 
+        buffers (dict):
+            Optional dictionary of reusable buffers, passed to prediction_probabilities. 
+            The target data is also stored here on the device. Default: None.
 
         Returns 
         -------------------
@@ -69,6 +120,8 @@ def validate(
             The cross entropy loss of the validation run. 
     """
 
+    model.eval()
+
     predictor = Prediction(
                         data = validation_data, 
                         model = model,
@@ -83,18 +136,31 @@ def validate(
 
     border = predictor.border
     loss_function = CustomCrossEntropy(weight=[0.01, 1.0, 1.0]).to(device)
-    target_data = validation_data.target_data[:,:,:] #border[0]:-1*border[0], border[1]:-1*border[1], border[2]:-1*border[2]]
 
-    # Add axis for minibatch size and send to device 
-    prediction_data_tensor = torch.tensor(ret['prediction'].data[np.newaxis]).to(device)
-    target_data_tensor = torch.tensor(target_data[np.newaxis]).to(device)
+    # Add axis for minibatch size and send to device. The target does not change between
+    # validation runs, so it is kept on the device when buffers are provided. The device 
+    # copy keeps the (smaller) dtype of the ground truth, leaving memory free for training, 
+    # and is only converted to int64 for the loss. 
+    if buffers is not None and 'target' in buffers:
+        target_data_tensor = buffers['target']
+    else:
+        target_dtype = validation_data.gt_data.dtype
+        if target_dtype not in (np.uint8, np.int8, np.int16, np.int32):
+            target_dtype = np.int64
+        target_data = validation_data.target_data[:,:,:] #border[0]:-1*border[0], border[1]:-1*border[1], border[2]:-1*border[2]]
+        target_data_tensor = torch.from_numpy(np.ascontiguousarray(target_data[np.newaxis], dtype=target_dtype)).to(device)
+        if buffers is not None:
+            buffers['target'] = target_data_tensor
+
+    prediction_data_tensor = torch.from_numpy(np.ascontiguousarray(ret['prediction'].data[np.newaxis])).to(device)
 
     loss = loss_function(prediction_data_tensor.float(), target_data_tensor.long())
     val_loss = loss.cpu().detach().numpy()
 
-    probs = torch.nn.Softmax(dim=0)(torch.tensor(ret['prediction'].data))
-    pos_pred_data = probs[1,:,:,:].detach().numpy()
-    neg_pred_data = probs[2,:,:,:].detach().numpy()
+    probs = prediction_probabilities(ret['prediction'].data, buffers=buffers)
+    # Channels are views into the single probability buffer
+    pos_pred_data = probs[1]
+    neg_pred_data = probs[2]
 
     hough_detection = HoughDetector(pred_pos = pos_pred_data,
                                     pred_neg = neg_pred_data,
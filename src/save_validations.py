@@ -4,6 +4,8 @@ import os
 import pandas as pd
 import zarr
 
+from numcodecs import Blosc
+
 
 class NumpyEncoder(json.JSONEncoder):
     """
@@ -37,8 +39,9 @@ def save_validations(best_validations: dict, save_path: str, data_path: str):
     if not os.path.exists(save_path):
         os.makedirs(save_path)
 
-    # Load the validation data to get attributes later
+    # Load the validation target attributes once, to copy onto each saved prediction
     f_data = zarr.open(data_path + "/validate", mode='r')
+    target_attrs = f_data['target'].attrs.asdict()
 
     for score_name, validation in best_validations.items():
 
@@ -74,7 +77,11 @@ def save_validations(best_validations: dict, save_path: str, data_path: str):
         hough_pred = best_prediction['Hough_transformed']
         save_location = f"{save_path}/{score_name}"
         f_save = zarr.open(save_location + "/prediction", mode='w')
-        f_save['Hough_transformed'] = hough_pred
-
-        for atr in f_data['target'].attrs:
-            f_save['Hough_transformed'].attrs[atr] = f_data['target'].attrs[atr]
\ No newline at end of file
+        hough_array = f_save.create_dataset(
+                            'Hough_transformed',
+                            data = hough_pred,
+                            chunks = (min(64, hough_pred.shape[0]), min(256, hough_pred.shape[1]), min(256, hough_pred.shape[2])),
+                            compressor = Blosc(cname='lz4', clevel=3, shuffle=Blosc.SHUFFLE)
+                            )
+
+        hough_array.attrs.update(target_attrs)
\ No newline at end of file
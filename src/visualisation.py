@@ -1,3 +1,4 @@
+import dask.array as da
 import napari
 import zarr
 
@@ -24,12 +25,12 @@ def imshow_napari_validation(data_path, prediction_path):
             prediction on the validation data. 
     """
 
-    # Load the data
+    # Load the data lazily, so napari only reads the chunks it displays
     f_data = zarr.open(data_path + "/validate", mode='r')
-    raw_data = f_data['raw'][:,:,:]
-    target_data = f_data['target'][:,:,:]
+    raw_data = da.from_zarr(f_data['raw'])
+    target_data = da.from_zarr(f_data['target'])
     f_prediction = zarr.open(prediction_path, mode='r')
-    hough_transformed = f_prediction['Hough_transformed'][:,:,:]
+    hough_transformed = da.from_zarr(f_prediction['Hough_transformed'])
 
     padding = [0,0,0]
 
@@ -69,10 +70,11 @@ def imshow_napari_prediction(data_path, prediction_path):
             prediction. 
     """
 
+    # Load the data lazily, so napari only reads the chunks it displays
     f = zarr.open(data_path + '/predict', mode='r')
-    raw_data = f['raw'][:,:,:]
+    raw_data = da.from_zarr(f['raw'])
     f_prediction = zarr.open(prediction_path, mode='r')
-    hough_transformed = f_prediction['/Hough_transformed'][:,:,:]
+    hough_transformed = da.from_zarr(f_prediction['/Hough_transformed'])
 
     # Obtain difference between input shape and output shape, to allow alignment in napari
     padding = [int((raw_data.shape[0]-hough_transformed.shape[0])/2), 